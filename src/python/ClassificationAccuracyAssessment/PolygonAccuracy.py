@@ -24,25 +24,48 @@ def PolygonAccuracy(polygon_rast: str, class_rast: str):
     assert isfile(polygon_rast), f'[ERROR] File {polygon_rast} not found. Exiting.'
     assert isfile(class_rast), f'[ERROR] File {class_rast} not found. Exiting.'
 
+    #NOTE (Eric): Let GDAL decompress tiles with all available cores
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+
     val_ds = gdal.Open(polygon_rast)
     class_ds = gdal.Open(class_rast)
 
-    val_arr = val_ds.GetRasterBand(1).ReadAsArray()
-    class_arr = class_ds.GetRasterBand(1).ReadAsArray()
+    val_band = val_ds.GetRasterBand(1)
+    class_band = class_ds.GetRasterBand(1)
+
+    cols = class_ds.RasterXSize
+    rows = class_ds.RasterYSize
 
     min_class = 1
-    max_class = class_arr.max()
+    max_class = int(class_band.ComputeRasterMinMax(False)[1])
 
-    conf_mat = np.zeros((max_class,max_class))
+    conf_mat = np.zeros(max_class*max_class, dtype=np.int64)
+
+    #NOTE (Eric): Stream the rasters in block-aligned windows so peak memory stays at
+    # one tile per raster instead of two full arrays, accumulating the bincount-based
+    # confusion matrix as we go
+    block_xsize, block_ysize = class_band.GetBlockSize()
+
+    for yoff in range(0, rows, block_ysize):
+        ysize = min(block_ysize, rows - yoff)
+
+        for xoff in range(0, cols, block_xsize):
+            xsize = min(block_xsize, cols - xoff)
+
+            val_arr = val_band.ReadAsArray(xoff, yoff, xsize, ysize)
+            class_arr = class_band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+            valid_mask = (val_arr >= min_class) & (val_arr <= max_class) & \
+                         (class_arr >= min_class) & (class_arr <= max_class)
+
+            val_flat = val_arr[valid_mask].astype(np.int64)
+            class_flat = class_arr[valid_mask].astype(np.int64)
+
+            conf_idx = (val_flat - min_class) * max_class + (class_flat - min_class)
+            conf_mat += np.bincount(conf_idx, minlength=max_class*max_class)
+
+    conf_mat = conf_mat.reshape(max_class,max_class).T * 25
 
-    for i in range(1,max_class+1):
-        val_mask = val_arr == i
-        class_masked = class_arr[val_mask]
-        for j in range(1,max_class+1):
-            class_masked_ij = class_masked == j
-            sum_ij = np.count_nonzero(class_masked_ij) * 25
-            conf_mat[j-1,i-1] = sum_ij
-    
     np.savetxt('D:\\EEJ\\ObjectBasedAccuracy\\ConfusionMatrix.csv', conf_mat, delimiter=',')
     
     print('Complete.')
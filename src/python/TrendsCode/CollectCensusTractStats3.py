@@ -10,12 +10,12 @@ import rasterio as rio
 import numpy as np
 import os
 
-from osgeo import gdal, ogr
+from osgeo import ogr
 from os.path import isfile, isdir
-from rasterstats import zonal_stats
+from rasterio import features
+from concurrent.futures import ThreadPoolExecutor
 from gc import collect
 from time import process_time
-from rasterio.mask import mask
 import matplotlib.pyplot as plt
 from scipy.stats import t
 
@@ -39,46 +39,31 @@ def AddRasterStatistics(shp_fn: str, ndvi_time_series_rast: str, lst_time_series
     assert isfile(ndvi_time_series_rast), f'[ERROR] File {ndvi_time_series_rast} not found. Exiting.'
     assert isfile(lst_time_series_rast), f'[ERROR] File {lst_time_series_rast} not found. Exiting.'
 
-    #NOTE (Eric): Extract spatial reference info for NDVI, LST (time series data) and classified green space
-    ndvi_ts_ds = gdal.Open(ndvi_time_series_rast)
-    lst_ts_ds = gdal.Open(lst_time_series_rast)
-    greenSpace_ds = gdal.Open(GreenSpaceClassRaster)
-    
-    #NOTE (Eric): Extract nodata values
-    ndvi_nodata = ndvi_ts_ds.GetRasterBand(1).GetNoDataValue()
-    lst_nodata = lst_ts_ds.GetRasterBand(1).GetNoDataValue()
-    gsc_nodata = greenSpace_ds.GetRasterBand(1).GetNoDataValue()
-    
-    #NOTE (Eric): Extract arrays of NDVI, LST, and green space classification rasters into memory
+    #NOTE (Eric): Open the NDVI, LST, and green space classification rasters once with
+    # rasterio; nodata values and transforms come from the same handles
     ndvi_src = rio.open(ndvi_time_series_rast)
     lst_src = rio.open(lst_time_series_rast)
     gsc_src = rio.open(GreenSpaceClassRaster)
-    
-    #NOTE (Eric): Intialize a list of year values for every middle year to iterate over
-    start_year = 1990
-    end_year = 2020
-
-    years = list(range(start_year,end_year))
-
-    #NOTE (Eric): Now we calculate the number of years since 1985 for each median year
-    since = []
-    for year in years:
-        since.append(year - start_year)
 
-    #NOTE (Eric): Create a time array for linear trend analysis
-    time_data = []
-    for year in since:
+    #NOTE (Eric): Extract nodata values
+    ndvi_nodata = ndvi_src.nodata
+    lst_nodata = lst_src.nodata
 
-        time_data.append(year)
+    #NOTE (Eric): Intialize the analysis period
+    start_year = 1990
+    end_year = 2020
 
-    #NOTE (Eric): Convert time list to stacked array
-    time_data = np.dstack(time_data)
+    #NOTE (Eric): Years since the start year for each median year
+    since = np.arange(end_year - start_year)
 
-    #NOTE (Eric): Store time stats for future linear trend analysis
-    n = time_data.shape[2]
-    xmean = np.nanmean(time_data, axis=2)
-    xmean_arr = np.dstack([xmean]*n)
-    xstd  = np.nanstd(time_data, axis=2)
+    #NOTE (Eric): The time axis is identical for every tract, so store its stats once
+    # as plain scalars and a 1-D deviation vector for the trend math below
+    n = len(since)
+    years_arr = np.arange(n, dtype=np.float64)
+    xmean = years_arr.mean()
+    xstd  = years_arr.std()
+    xvar  = xstd*xstd
+    xdev  = years_arr - xmean
 
     #NOTE (Eric): Census tract/zip code id field name we will use to filter the stats by (Census tract: 'GEOID', zip code: 'zcta')
     filt_field_name = 'zcta'
@@ -89,6 +74,49 @@ def AddRasterStatistics(shp_fn: str, ndvi_time_series_rast: str, lst_time_series
     #NOTE (Eric): Extract the tract ids as a list
     tract_ids = gdf[filt_field_name].tolist()
 
+    #NOTE (Eric): Rasterize all census tracts once into a zone label raster (0 = background)
+    # on the green space classification grid
+    zones = features.rasterize([(geom, i+1) for i, geom in enumerate(gdf.geometry)],
+                               out_shape=(gsc_src.height, gsc_src.width),
+                               transform=gsc_src.transform, dtype='int32')
+
+    #NOTE (Eric): Collect the total area of our three classes (1 - Green, 2 - Water, 3 - Urban)
+    # for every tract in one fused bincount over a combined (zone, class) index,
+    # rather than one pass over the classification raster per class
+    gsc_arr = gsc_src.read(1)
+    n_tracts = len(tract_ids)
+
+    gsc_flat = gsc_arr.ravel().astype(np.int64)
+    zone_flat = zones.ravel().astype(np.int64)
+    class_valid = (gsc_flat >= 1) & (gsc_flat <= 3)
+
+    area_idx = zone_flat[class_valid]*3 + (gsc_flat[class_valid] - 1)
+    class_areas = np.bincount(area_idx, minlength=(n_tracts+1)*3).reshape(n_tracts+1, 3)[1:] * 5 * 5
+
+    #NOTE (Eric): Read both time series cubes into memory once (bands x H x W) and set
+    # nodata = np.nan up front, replacing the per-tract mask() dataset reads
+    ndvi_cube = ndvi_src.read().astype(np.float32, copy=False)
+    lst_cube = lst_src.read().astype(np.float32, copy=False)
+
+    ndvi_cube[ndvi_cube == ndvi_nodata] = np.nan
+    lst_cube[lst_cube == lst_nodata] = np.nan
+
+    #NOTE (Eric): Rasterize the tracts once more onto the time series grid (NDVI and
+    # LST share the same grid)
+    ts_zones = features.rasterize([(geom, i+1) for i, geom in enumerate(gdf.geometry)],
+                                  out_shape=(ndvi_src.height, ndvi_src.width),
+                                  transform=ndvi_src.transform, dtype='int32')
+
+    #NOTE (Eric): Group pixel indices by tract with one argsort so each tract's time
+    # series can be gathered directly, without rescanning the zone raster per tract
+    ts_zones_flat = ts_zones.ravel()
+    pixel_order = np.argsort(ts_zones_flat, kind='stable')
+    zone_bounds = np.searchsorted(ts_zones_flat[pixel_order], np.arange(1, n_tracts+2))
+    tract_pixels = [pixel_order[zone_bounds[i]:zone_bounds[i+1]] for i in range(n_tracts)]
+
+    ndvi_flat = ndvi_cube.reshape(ndvi_cube.shape[0], -1)
+    lst_flat = lst_cube.reshape(lst_cube.shape[0], -1)
+
     #NOTE (Eric): Open shapefile and append stats as a new column
     shp_ds = ogr.Open(shp_fn, 1)
     layer = shp_ds.GetLayer()
@@ -111,120 +139,111 @@ def AddRasterStatistics(shp_fn: str, ndvi_time_series_rast: str, lst_time_series
             field_dfn = ogr.FieldDefn(f'{stat_lab}{ts_rast_lab}', ogr.OFTReal)
             layer.CreateField(field_dfn)
 
-    for tract_id in tract_ids:
-        
-        #NOTE (Eric): Filter the census tracts by unique ID
-        filt_gdf = gdf[gdf[filt_field_name] == tract_id]
-        
-        #NOTE (Eric): Clip the in-mem rasters using the filtered shapefile geometry
-        try:
-            in_mem_ndvi, ndvi_out_transform = mask(ndvi_src, filt_gdf.geometry, crop=True)
-            in_mem_lst, lst_out_transform = mask(lst_src, filt_gdf.geometry, crop=True)
-            in_mem_gsc, gsc_out_transform = mask(gsc_src, filt_gdf.geometry, crop=True)
-        
-        except Exception as e:
-            continue
-         
-
-        #NOTE (Eric): Set NDVI/LST nodata = np.nan
-        in_mem_ndvi[in_mem_ndvi == ndvi_nodata] = np.nan
-        in_mem_lst[in_mem_lst == lst_nodata] = np.nan
-        
-
-        #NOTE (Eric): Copy and update the metadatas
-        ndvi_out_meta = ndvi_src.meta.copy()
-        lst_out_meta = ndvi_src.meta.copy()
-        gsc_out_meta = ndvi_src.meta.copy()
-
-        ndvi_out_meta.update({
-            "driver": "GTiff",
-            "height": in_mem_ndvi.shape[1],
-            "width": in_mem_ndvi.shape[2],
-            "transform": ndvi_out_transform})
-        
-        lst_out_meta.update({
-            "driver": "GTiff",
-            "height": in_mem_ndvi.shape[1],
-            "width": in_mem_ndvi.shape[2],
-            "transform": lst_out_transform})
-        
-        gsc_out_meta.update({
-            "driver": "GTiff",
-            "height": in_mem_ndvi.shape[1],
-            "width": in_mem_ndvi.shape[2],
-            "transform": gsc_out_transform})
-        
-        #NOTE (Eric): Create empty arrays that will contain median NDVI/LST data
-        ndvi_band_data = []
-        lst_band_data = []
-        
-        #NOTE (Eric): Collect median NDVI/LST stats at each timestep
-        for year in since:
-
-            median_ndvi = np.nanmedian(in_mem_ndvi[year,:,:])
-            median_lst = np.nanmedian(in_mem_lst[year,:,:])
-
-            ndvi_band_data.append(median_ndvi)
-            lst_band_data.append(median_lst)
-
-
-        #NOTE (Eric): Convert NDVI and LST lists to stacked arrays
-        ndvi_band_data = np.dstack(ndvi_band_data)
-        lst_band_data = np.dstack(lst_band_data)
-        
-        #NOTE (Eric): Perform linear trend analysis using the annual tract-level medians for NDVI + LST
+    #NOTE (Eric): Map tract ids to feature FIDs once, so each update is a direct
+    # GetFeature lookup instead of an attribute-filtered scan of the whole layer
+    fid_map = {}
+    layer.ResetReading()
+    for feat in layer:
+        fid_map[feat.GetField(filt_field_name)] = feat.GetFID()
+    feat = None
+
+    def ComputeTractStats(tract_item):
+
+        """""
+        Worker computing the full field name -> value dict for one tract. Pure numpy,
+        so threads scale (the reductions release the GIL); no OGR access in here.
+        """""
+
+        tract_row, tract_id = tract_item
+
+        #NOTE (Eric): Gather this tract's pixels from the in-memory cubes
+        tract_pix = tract_pixels[tract_row]
+
+        if tract_pix.size == 0:
+            return None
+
+        #NOTE (Eric): Collect median NDVI/LST stats at every timestep in one reduction
+        # over the tract's pixels rather than one nanmedian call per year
+        ndvi_band_data = np.nanmedian(ndvi_flat[:, tract_pix], axis=1)
+        lst_band_data = np.nanmedian(lst_flat[:, tract_pix], axis=1)
+
+        tract_stats = {}
+
+        #NOTE (Eric): Perform linear trend analysis using the annual tract-level medians
+        # for NDVI + LST - pure 1-D/scalar math against the precomputed time vector
         for band_data, ts_rast_lab in zip([ndvi_band_data, lst_band_data], ts_rast_labs):
 
-            ymean = np.nanmean(band_data, axis=2)
-            ymean_arr = np.dstack([ymean]*n)
-            ystd  = np.nanstd(band_data, axis=2)
+            ymean = np.nanmean(band_data)
+            ystd  = np.nanstd(band_data)
 
             # Compute covariance along time axis
-            cov =  np.nansum((time_data - xmean_arr)*(band_data - ymean_arr), axis=2)/(n)
-            
+            cov = np.nansum(xdev*(band_data - ymean))/(n)
+
             # Compute correlation along time axis
             cor = cov/(xstd*ystd)
-            
+
             # Compute regression slope and intercept:
-            slope = cov/(xstd**2)
-            intercept = ymean - xmean*slope  
-            
+            slope = cov/xvar
+            intercept = ymean - xmean*slope
+
             # Compute P-value and standard error
             # Compute t-statistics
             tstats = cor*np.sqrt(n-2)/np.sqrt(1-cor**2)
-            stderr = slope/tstats
-            pval   = t.sf(tstats, n-2)*2
-
-            #NOTE (Eric): Filter the layer by current feature ID (ogr) 
-            layer.SetAttributeFilter(f"{filt_field_name} = '{tract_id}'")
-
-            for feat in layer:
-                feat.SetField(f'{stat_labs[0]}{ts_rast_lab}', cov[0][0])
-                feat.SetField(f'{stat_labs[1]}{ts_rast_lab}', cor[0][0])
-                feat.SetField(f'{stat_labs[2]}{ts_rast_lab}', intercept[0][0])
-                feat.SetField(f'{stat_labs[3]}{ts_rast_lab}', float(band_data[0,0, band_idx]))
-                feat.SetField(f'{stat_labs[4]}{ts_rast_lab}', pval[0][0])
-                feat.SetField(f'{stat_labs[5]}{ts_rast_lab}', slope[0][0])
-                feat.SetField(f'{stat_labs[6]}{ts_rast_lab}', stderr[0][0])
-                feat.SetField(f'{stat_labs[7]}{ts_rast_lab}', tstats[0][0])
-                layer.SetFeature(feat)
-        
-        #NOTE (Eric): Filter the layer by current feature ID (ogr) 
-        layer.SetAttributeFilter(f"{filt_field_name} = '{tract_id}'")
-
-        #NOTE (Eric): Determine how much area is covered by our three classes (1 - Green, 2 - Water, 3 - Urban)
-        for i, class_lab, in zip([1,2,3],['green', 'water', 'urban']):
-
-            #NOTE (Eric): We are going to logically filter the class raster to only include values for green spaces
-            greenSpace_arr_indx = in_mem_gsc == i
-            class_area = greenSpace_arr_indx.sum() * 5 * 5
-
-            for feat in layer:
-                feat.SetField(f'{class_lab}Area', float(class_area))
-                layer.SetFeature(feat)
-
-
-        
+
+            #NOTE (Eric): Only evaluate the standard error and p-value on finite,
+            # nonzero t-statistics so empty tracts stay nan
+            if np.isfinite(tstats):
+                stderr = slope/tstats if tstats != 0 else np.nan
+                pval = t.sf(tstats, n-2)*2
+            else:
+                stderr = np.nan
+                pval = np.nan
+
+            tract_stats[f'{stat_labs[0]}{ts_rast_lab}'] = float(cov)
+            tract_stats[f'{stat_labs[1]}{ts_rast_lab}'] = float(cor)
+            tract_stats[f'{stat_labs[2]}{ts_rast_lab}'] = float(intercept)
+            tract_stats[f'{stat_labs[3]}{ts_rast_lab}'] = float(band_data[band_idx])
+            tract_stats[f'{stat_labs[4]}{ts_rast_lab}'] = float(pval)
+            tract_stats[f'{stat_labs[5]}{ts_rast_lab}'] = float(slope)
+            tract_stats[f'{stat_labs[6]}{ts_rast_lab}'] = float(stderr)
+            tract_stats[f'{stat_labs[7]}{ts_rast_lab}'] = float(tstats)
+
+        #NOTE (Eric): Class areas (1 - Green, 2 - Water, 3 - Urban) were collected for all
+        # tracts in one pass above, so here we only look up this tract's row
+        for class_col, class_lab in zip([0,1,2],['green', 'water', 'urban']):
+            tract_stats[f'{class_lab}Area'] = float(class_areas[tract_row, class_col])
+
+        return tract_id, tract_stats
+
+    #NOTE (Eric): Tracts are independent, so spread the compute across a thread pool;
+    # OGR writes stay on this thread because ogr layers are not thread-safe
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        results = list(pool.map(ComputeTractStats, enumerate(tract_ids)))
+
+    #NOTE (Eric): Batch all feature updates into one transaction where the driver
+    # supports it, so we do not pay a sync per SetFeature
+    if layer.TestCapability(ogr.OLCTransactions):
+        layer.StartTransaction()
+
+    for result in results:
+
+        if result is None:
+            continue
+
+        tract_id, tract_stats = result
+
+        #NOTE (Eric): Fetch the tract's feature directly by FID
+        feat = layer.GetFeature(fid_map[tract_id])
+        for field_name, field_val in tract_stats.items():
+            feat.SetField(field_name, field_val)
+        layer.SetFeature(feat)
+        feat = None
+
+    if layer.TestCapability(ogr.OLCTransactions):
+        layer.CommitTransaction()
+
+
+
 
 
 if __name__ == "__main__": 
@@ -1,197 +1,265 @@
-# Code written to extract p-values from Landsat time series rasters of greenness 
-# (NDVI) and land surface temperature (LST). Time series rasters have been aggregated
-# to 3-year medians, where the 3-year median value at each pixel has been placed into 
-# each band of the raster. Analysis period: 1990- 2019
-# Author: Eric Romero
-# Date: 6/12/2023
-
-from osgeo import gdal, ogr
-from scipy.stats import t
-from os.path import isfile
-
-import numpy as np 
-
-def WarpToMatchResolution(src_ds: str, match_ds: str, dst_fn: str,
-                           resample_alg: str, cutline_fn):
-    
-    """""
-    Function creates matches spatial resolution and spatial reference
-    of source raster to that of the matched raster dataset.
-
-    src_fn: file path to raster data on disk
-    match_fn: file path to the raster whose reference we want to mimic
-    src_fn_base: filename extension of source dataset with file extension (e.g., .tif) removed
-    resample alg: gdal compatible string indicating resample algorithm
-    cutline_fn: Vector data to limit analysis area
-
-    """""
-
-    # NOTE (Eric): Extract extent data to convert input raster to output extent + resolution.
-    src_srs = src_ds.GetSpatialRef()
-
-    match_srs = match_ds.GetSpatialRef()
-    match_gt = match_ds.GetGeoTransform()
-
-    match_width = match_ds.RasterXSize
-    match_height = match_ds.RasterYSize
-
-    match_x_res = match_gt[1]
-    match_y_res = match_gt[5]
-
-    match_ulx = match_gt[0]
-    match_lrx = match_ulx + match_x_res * match_width
-
-    match_uly = match_gt[3]
-    match_lry = match_uly + match_y_res * match_height
-
-    match_bounds = [match_ulx, match_lry, match_lrx, match_uly]
-
-    #NOTE (Eric): Get src data type and nodata value
-    gdal_no_data_value = src_ds.GetRasterBand(1).GetNoDataValue()
-    gdal_data_type = src_ds.GetRasterBand(1).DataType
-    
-    if gdal_no_data_value is None:   
-        gdal_no_data_value = -9999
-
-    # NOTE (Eric): If input cutline is valid, clip the output raster by extent
-    cutline_ds = ogr.Open(cutline_fn)
-    cutline_layer = cutline_ds.GetLayer()
-    cutline_ds_name = cutline_ds.GetName()
-    cutline_layer_name = cutline_layer.GetName()
-    cutline_extent = cutline_layer.GetExtent()
-    match_width = int((cutline_extent[1] - cutline_extent[0]) / match_x_res)
-    match_height = int((cutline_extent[2] - cutline_extent[3] ) / match_y_res)
-    match_bounds = [cutline_extent[0], cutline_extent[2], cutline_extent[1], cutline_extent[3]]
-    print('Beginning warping process.')
-
-    creation_options = ['BIGTIFF = IF_NEEDED', 'COMPRESS = LZW', 
-                    'PREDICTOR=3', 'Tiled=YES', 'BLOCKXSIZE=256',
-                        'BLOCKYSIZE=256', 'SPARSE_OK=True', 'NUM_THREADS=ALL_CPUS']
-        
-    gdal.Warp(dst_fn, src_ds, format='GTIFF', multithread='YES',
-              dstNodata = gdal_no_data_value, outputType = gdal_data_type, 
-              width=match_width, height=match_height, outputBoundsSRS=match_srs,
-              outputBounds=match_bounds, srcSRS=src_srs, dstSRS=match_srs,
-              resampleAlg=resample_alg, cutlineDSName=cutline_ds_name,
-              cutlineLayer=cutline_layer_name, options=creation_options)
-
-def RasterLinModel(raster_fn: str, start_year: int, end_year: int):
-    """""
-    Function takes input raster which contains 3 year median values of a variable of interest.
-    Year rasters of the same size and shape of the input raster is created using the designated 
-    start year and end year.
-
-    raster_fn: string: path to raster for analysis
-    start_year: int: year of beginning analysis (inclusive)
-    end_year: int: year of ending analysis (inclusive)
-
-    Followed guidance here: https://hrishichandanpurkar.blogspot.com/2017/09/vectorized-functions-for-correlation.html
-
-    """""
-    #NOTE (Eric): Ensure input file is valid
-    assert isfile(raster_fn), f'[ERROR] File {raster_fn} not found. Exiting.'
-
-    #NOTE (Eric): Set output file name statistical raster based on input filename
-    in_fn_components = raster_fn.split('\\')
-    out_fn = 'D:\\EEJ\\Trends\\TrendData\\StatsRasters\\' + '\\' + in_fn_components[-1][:-4] + 'LinearTrendStats.tif'
-
-    #NOTE (Eric): Intialize a list of year values for every middle year to iterate over
-    years = list(range(start_year+1,end_year+1,3))
-
-    #NOTE (Eric): Now we calculate the number of years since 1985 for each median year
-    since = []
-    for year in years:
-        since.append(year - start_year)
-
-
-    #NOTE (Eric): Spatial Reference
-    ds = gdal.Open(raster_fn)
-    gt = ds.GetGeoTransform()
-    proj = ds.GetProjection()
-    srs = ds.GetSpatialRef()
-    
-    #NOTE (Eric): Dimensions
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
-    bands = ds.RasterCount
-
-    band_data = []
-    time_data = []
-    for band in range(bands):
-
-        year = since[band]
-        arr = ds.GetRasterBand(band+1).ReadAsArray()
-        time_arr = np.full(arr.shape, year, dtype=np.float64)
-        
-        #NOTE (Eric): Replace nodata with nans
-        nodata = ds.GetRasterBand(band+1).GetNoDataValue()
-        arr[arr == nodata] = np.nan
-        time_arr[arr == nodata] = np.nan 
-
-        band_data.append(arr)
-        time_data.append(time_arr)
-    
-    band_data = np.dstack(band_data)
-    time_data = np.dstack(time_data)
-
-    # Compute data length, mean and standard deviation along time axis for further use: 
-    n = band_data.shape[2]
-    xmean = np.nanmean(time_data, axis=2)
-    xmean_arr = np.dstack([xmean]*n)
-    ymean = np.nanmean(band_data, axis=2)
-    ymean_arr = np.dstack([ymean]*n)
-    xstd  = np.nanstd(time_data, axis=2)
-    ystd  = np.nanstd(band_data, axis=2)
-
-    # Compute covariance along time axis
-    cov =  np.nansum((time_data - xmean_arr)*(band_data - ymean_arr), axis=2)/(n)
-    
-    # Compute correlation along time axis
-    cor = cov/(xstd*ystd)
-    
-    # Compute regression slope and intercept:
-    slope = cov/(xstd**2)
-    intercept = ymean - xmean*slope  
-    
-    # Compute P-value and standard error
-    # Compute t-statistics
-    tstats = cor*np.sqrt(n-2)/np.sqrt(1-cor**2)
-    stderr = slope/tstats
-    pval   = t.sf(tstats, n-2)*2
-
-    #NOTE (Eric): Create matching list of statistic labels and variables
-    stat_labs = ['covaraince', 'correlation', 'slope', 'intercept', 'tstat', 'stderr', 'pval']
-    stat_list = [cov, cor, slope, intercept, tstats, stderr, pval]
-
-    #NOTE (Eric): Now, we will write our statistical rasters to disk
-    driver = gdal.GetDriverByName("MEM")
-    out_ds = driver.Create('mem_raster', cols, rows, 7, gdal.GDT_Float64)#, options=creation_options)
-
-    out_ds.SetGeoTransform(gt)
-    out_ds.SetProjection(proj)
-    out_ds.SetSpatialRef(srs)
-
-    #NOTE (Eric): Shapefile for clipping
-    clipping_cutline_fn = "D:\\EEJ\\StateData\\shp\\BayAreaBlockGroupsDissolved.shp"
-    assert isfile(clipping_cutline_fn), f'[ERROR] File {clipping_cutline_fn} not found. Exiting.'
-
-    b = 0
-    for stat, lab in list(zip(stat_list, stat_labs)):
-        b+=1
-      
-        out_ds.GetRasterBand(b).SetNoDataValue(-9999.0)
-        out_ds.GetRasterBand(b).SetDescription(lab)
-        out_ds.GetRasterBand(b).WriteArray(stat)
-        
-    WarpToMatchResolution(out_ds, out_ds, out_fn, 'near', clipping_cutline_fn)
-    out_ds = None
-
-
-
-if __name__ == "__main__": 
-    from sys import argv
-    try:
-        RasterLinModel(argv[1], int(argv[2]), int(argv[3]))
-    except Exception as e:
-        print(e)    
-
+# Code written to extract p-values from Landsat time series rasters of greenness 
+# (NDVI) and land surface temperature (LST). Time series rasters have been aggregated
+# to 3-year medians, where the 3-year median value at each pixel has been placed into 
+# each band of the raster. Analysis period: 1990- 2019
+# Author: Eric Romero
+# Date: 6/12/2023
+
+from osgeo import gdal, ogr
+from scipy.stats import t
+from os.path import isfile
+from numba import njit, prange
+
+import numpy as np
+
+#NOTE (Eric): Enable multi-threaded raster IO and a larger block cache for GDAL
+gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+gdal.SetCacheMax(2<<30)
+
+def WarpToMatchResolution(src_ds: str, match_ds: str, dst_fn: str,
+                           resample_alg: str, cutline_fn):
+    
+    """""
+    Function creates matches spatial resolution and spatial reference
+    of source raster to that of the matched raster dataset.
+
+    src_fn: file path to raster data on disk
+    match_fn: file path to the raster whose reference we want to mimic
+    src_fn_base: filename extension of source dataset with file extension (e.g., .tif) removed
+    resample alg: gdal compatible string indicating resample algorithm
+    cutline_fn: Vector data to limit analysis area
+
+    """""
+
+    # NOTE (Eric): Extract extent data to convert input raster to output extent + resolution.
+    src_srs = src_ds.GetSpatialRef()
+
+    match_srs = match_ds.GetSpatialRef()
+    match_gt = match_ds.GetGeoTransform()
+
+    match_width = match_ds.RasterXSize
+    match_height = match_ds.RasterYSize
+
+    match_x_res = match_gt[1]
+    match_y_res = match_gt[5]
+
+    match_ulx = match_gt[0]
+    match_lrx = match_ulx + match_x_res * match_width
+
+    match_uly = match_gt[3]
+    match_lry = match_uly + match_y_res * match_height
+
+    match_bounds = [match_ulx, match_lry, match_lrx, match_uly]
+
+    #NOTE (Eric): Get src data type and nodata value
+    gdal_no_data_value = src_ds.GetRasterBand(1).GetNoDataValue()
+    gdal_data_type = src_ds.GetRasterBand(1).DataType
+    
+    if gdal_no_data_value is None:   
+        gdal_no_data_value = -9999
+
+    # NOTE (Eric): If input cutline is valid, clip the output raster by extent
+    cutline_ds = ogr.Open(cutline_fn)
+    cutline_layer = cutline_ds.GetLayer()
+    cutline_ds_name = cutline_ds.GetName()
+    cutline_layer_name = cutline_layer.GetName()
+    cutline_extent = cutline_layer.GetExtent()
+    match_width = int((cutline_extent[1] - cutline_extent[0]) / match_x_res)
+    match_height = int((cutline_extent[2] - cutline_extent[3] ) / match_y_res)
+    match_bounds = [cutline_extent[0], cutline_extent[2], cutline_extent[1], cutline_extent[3]]
+    print('Beginning warping process.')
+
+    #NOTE (Eric): Creation option strings must not contain spaces or GDAL silently
+    # ignores them
+    creation_options = ['BIGTIFF=IF_NEEDED', 'COMPRESS=LZW',
+                    'PREDICTOR=3', 'TILED=YES', 'BLOCKXSIZE=256',
+                        'BLOCKYSIZE=256', 'SPARSE_OK=TRUE', 'NUM_THREADS=ALL_CPUS']
+
+    gdal.Warp(dst_fn, src_ds, format='GTIFF', multithread=True,
+              warpMemoryLimit=1<<30, warpOptions=['NUM_THREADS=ALL_CPUS'],
+              dstNodata = gdal_no_data_value, outputType = gdal_data_type, 
+              width=match_width, height=match_height, outputBoundsSRS=match_srs,
+              outputBounds=match_bounds, srcSRS=src_srs, dstSRS=match_srs,
+              resampleAlg=resample_alg, cutlineDSName=cutline_ds_name,
+              cutlineLayer=cutline_layer_name, creationOptions=creation_options)
+
+@njit(parallel=True, cache=True)
+def TrendKernel(band_data, years, stats):
+
+    """""
+    Fused per-pixel linear trend kernel. Streams each pixel's time series once,
+    accumulating the running sums needed for covariance, correlation, slope,
+    intercept, t-statistic and standard error while skipping NaNs inline.
+
+    band_data: rows x cols x n float cube of median values
+    years: n-length float vector of years since the start year
+    stats: preallocated 7 x rows x cols output; bands 0-5 are filled here
+           (cov, cor, slope, intercept, tstat, stderr), band 6 (pval) is
+           computed by the caller
+
+    """""
+
+    rows, cols, n = band_data.shape
+
+    for r in prange(rows):
+        for c in range(cols):
+
+            sx = 0.0
+            sy = 0.0
+            sxx = 0.0
+            syy = 0.0
+            sxy = 0.0
+            count = 0
+
+            for k in range(n):
+                y = band_data[r, c, k]
+                if np.isnan(y):
+                    continue
+                x = years[k]
+                sx += x
+                sy += y
+                sxx += x*x
+                syy += y*y
+                sxy += x*y
+                count += 1
+
+            if count < 3:
+                for s in range(6):
+                    stats[s, r, c] = np.nan
+                continue
+
+            xmean = sx/count
+            ymean = sy/count
+            xvar = sxx/count - xmean*xmean
+            yvar = syy/count - ymean*ymean
+            cov = sxy/count - xmean*ymean
+
+            if xvar <= 0.0 or yvar <= 0.0:
+                for s in range(6):
+                    stats[s, r, c] = np.nan
+                continue
+
+            cor = cov/np.sqrt(xvar*yvar)
+            slope = cov/xvar
+            intercept = ymean - xmean*slope
+            tstat = cor*np.sqrt(count-2)/np.sqrt(1.0-cor*cor)
+
+            if tstat != 0.0:
+                stderr = slope/tstat
+            else:
+                stderr = np.nan
+
+            stats[0, r, c] = cov
+            stats[1, r, c] = cor
+            stats[2, r, c] = slope
+            stats[3, r, c] = intercept
+            stats[4, r, c] = tstat
+            stats[5, r, c] = stderr
+
+def RasterLinModel(raster_fn: str, start_year: int, end_year: int):
+    """""
+    Function takes input raster which contains 3 year median values of a variable of interest.
+    Year rasters of the same size and shape of the input raster is created using the designated 
+    start year and end year.
+
+    raster_fn: string: path to raster for analysis
+    start_year: int: year of beginning analysis (inclusive)
+    end_year: int: year of ending analysis (inclusive)
+
+    Followed guidance here: https://hrishichandanpurkar.blogspot.com/2017/09/vectorized-functions-for-correlation.html
+
+    """""
+    #NOTE (Eric): Ensure input file is valid
+    assert isfile(raster_fn), f'[ERROR] File {raster_fn} not found. Exiting.'
+
+    #NOTE (Eric): Set output file name statistical raster based on input filename
+    in_fn_components = raster_fn.split('\\')
+    out_fn = 'D:\\EEJ\\Trends\\TrendData\\StatsRasters\\' + '\\' + in_fn_components[-1][:-4] + 'LinearTrendStats.tif'
+
+    #NOTE (Eric): Years since the start year for each middle median year
+    since = np.arange(start_year+1, end_year+1, 3) - start_year
+
+    #NOTE (Eric): Spatial Reference
+    ds = gdal.Open(raster_fn)
+    gt = ds.GetGeoTransform()
+    proj = ds.GetProjection()
+    srs = ds.GetSpatialRef()
+    
+    #NOTE (Eric): Dimensions
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+    bands = ds.RasterCount
+
+    n = bands
+    years_arr = np.asarray(since, dtype=np.float32)
+
+    stats = np.empty((7, rows, cols), dtype=np.float64)
+
+    #NOTE (Eric): Process the raster in tiles: read one window across all bands, run the
+    # fused trend kernel on it and write that window of the stats cube. The working set
+    # is one tile instead of the full H x W x n cube, so the reduction stays in cache
+    tile_size = 1024
+
+    for yoff in range(0, rows, tile_size):
+        ysize = min(tile_size, rows - yoff)
+
+        for xoff in range(0, cols, tile_size):
+            xsize = min(tile_size, cols - xoff)
+
+            #NOTE (Eric): float32 is plenty for NDVI/LST medians and halves the bytes
+            # the kernel has to stream
+            tile = np.dstack([ds.GetRasterBand(band+1).ReadAsArray(xoff, yoff, xsize, ysize)
+                              for band in range(bands)]).astype(np.float32, copy=False)
+
+            #NOTE (Eric): Replace nodata with nans
+            for band in range(bands):
+                nodata = ds.GetRasterBand(band+1).GetNoDataValue()
+                band_tile = tile[:,:,band]
+                band_tile[band_tile == nodata] = np.nan
+
+            TrendKernel(tile, years_arr, stats[:, yoff:yoff+ysize, xoff:xoff+xsize])
+
+    # Compute P-value from the t-statistics (vectorized in scipy, outside the kernel),
+    # only on finite t-statistics - masked pixels keep nan instead of paying for the
+    # incomplete beta evaluation
+    tstats = stats[4]
+    finite = np.isfinite(tstats)
+    stats[6] = np.nan
+    stats[6][finite] = t.sf(tstats[finite], n-2)*2
+
+    #NOTE (Eric): Create matching list of statistic labels and variables
+    stat_labs = ['covaraince', 'correlation', 'slope', 'intercept', 'tstat', 'stderr', 'pval']
+    stat_list = [stats[b] for b in range(7)]
+
+    #NOTE (Eric): Now, we will write our statistical rasters to disk
+    driver = gdal.GetDriverByName("MEM")
+    out_ds = driver.Create('mem_raster', cols, rows, 7, gdal.GDT_Float64)#, options=creation_options)
+
+    out_ds.SetGeoTransform(gt)
+    out_ds.SetProjection(proj)
+    out_ds.SetSpatialRef(srs)
+
+    #NOTE (Eric): Shapefile for clipping
+    clipping_cutline_fn = "D:\\EEJ\\StateData\\shp\\BayAreaBlockGroupsDissolved.shp"
+    assert isfile(clipping_cutline_fn), f'[ERROR] File {clipping_cutline_fn} not found. Exiting.'
+
+    b = 0
+    for stat, lab in list(zip(stat_list, stat_labs)):
+        b+=1
+      
+        out_ds.GetRasterBand(b).SetNoDataValue(-9999.0)
+        out_ds.GetRasterBand(b).SetDescription(lab)
+        out_ds.GetRasterBand(b).WriteArray(stat)
+        
+    WarpToMatchResolution(out_ds, out_ds, out_fn, 'near', clipping_cutline_fn)
+    out_ds = None
+
+
+
+if __name__ == "__main__": 
+    from sys import argv
+    try:
+        RasterLinModel(argv[1], int(argv[2]), int(argv[3]))
+    except Exception as e:
+        print(e)    
+